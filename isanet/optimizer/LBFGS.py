@@ -11,10 +11,14 @@ So the quantity that will be monitored in the interation log will be::
 
 Update rule for parameter w with gradient g::
         
-        d = - self.__compute_search_dir(g, H0, self.__s, self.__y)
+        gamma = s^T*y / y^T*y
+        d = - self.__compute_search_dir(g, gamma)
         alpha = line_search_strong_wolfe 
         w += alpha*d
 
+The initial Hessian approximation H0 = gamma*I is never built as a matrix, 
+it is applied to a vector as a scalar product (r = gamma*q).
+
 Note
 ----
 For major details on the implementation refer to Wright and Nocedal,
@@ -23,7 +27,6 @@ For major details on the implementation refer to Wright and Nocedal,
 
 import numpy as np
 import time
-import copy
 import isanet.metrics as metrics
 from isanet.optimizer import Optimizer
 from isanet.optimizer.linesearch import line_search_wolfe, line_search_wolfe_f, phi_function
@@ -31,6 +34,13 @@ from isanet.optimizer.utils import make_vector, restore_w_to_model
 
 class LBFGS(Optimizer):
     """Limited-memory BFGS (L-BFGS)
+
+    The inverse Hessian approximation is never stored as a matrix: the 
+    search direction is computed from the 'm' stored pairs (s, y) and the 
+    scalar gamma (H0 = gamma*I), so time and memory are O(m*n_vars).
+    A pair with weak curvature (0 < y^T s <= 1e-8) is ignored by the 
+    recursion, a negative curvature raises an exception. During the first 
+    epoch the steepest descent direction is used.
     
     Parameters
     ----------
@@ -68,10 +78,33 @@ class LBFGS(Optimizer):
     debug : boolean, default=False
         If True, allows you to perform iterations one at a time, pressing the Enter key.
 
+    dtype : data-type, default=numpy.float32
+        Data type of the stored curvature pairs (s, y) and of the vectors of 
+        the two-loop recursion, numpy.float32 or numpy.float64. The weights, the gradient and the scalar 
+        products (rho, gamma, curvature condition) are always in double precision. 
+        If the cosine between s and y of the newest pair drops below 1e-6, 
+        the pairs are promoted to float64 for the rest of the optimization.
+
+    newton_cg_vars : integer, default=0
+        If the model has at most 'newton_cg_vars' variables, the search 
+        direction is computed with a truncated Newton-CG method instead of 
+        the two-loop recursion: at most 'cg_maxiter' Conjugate Gradient 
+        iterations on H*d = -g, where the Hessian-vector products are 
+        approximated by finite differences of the gradient::
+
+                H*v ~ (g(w + eps*v) - g(w))/eps
+
+        Each product costs one backpropagation. 0 disables it.
+
+    cg_maxiter : integer, default=5
+        Maximum number of CG iterations of the Newton-CG direction.
+
     Attributes
     ----------
     history : dict
-        Save for each iteration some interesting values.
+        Save for each iteration some interesting values. Each value is an 
+        array with one element per iteration (a view into storage that is
+        preallocated for all the iterations of the optimization).
 
         Dictionary's keys:
             ``alpha``
@@ -94,28 +127,119 @@ class LBFGS(Optimizer):
     """
     def __init__(self, m = 3, c1=1e-4, c2=.9, ln_maxiter = 10, tol = None, 
                  n_iter_no_change = None, norm_g_eps = None, l_eps = None, 
-                 debug = False):
+                 debug = False, dtype = np.float32, newton_cg_vars = 0, cg_maxiter = 5):
         super().__init__(loss="loss_mse_reg", tol = tol, n_iter_no_change = n_iter_no_change, norm_g_eps = norm_g_eps, l_eps = l_eps, debug = debug)
         self.c1 = c1
         self.c2 = c2
         self.m = m
         self.restart = 0
         self.ln_maxiter = ln_maxiter
-        self.history = {"alpha":        [],
-                        "norm_g":       [],
-                        "ls_conv":      [],
-                        "ls_it":        [],
-                        "ls_time":      [],
-                        "zoom_used":    [],
-                        "zoom_conv":    [],
-                        "zoom_it":      []} 
+        # the kernels are compiled only for single and double precision pairs
+        if np.dtype(dtype) not in (np.float32, np.float64):
+            raise ValueError("dtype must be numpy.float32 or numpy.float64, got {}".format(np.dtype(dtype)))
+        self.dtype = dtype
+        self.newton_cg_vars = newton_cg_vars
+        self.cg_maxiter = cg_maxiter
+        self.__history = {"alpha":      np.empty(0),
+                          "norm_g":     np.empty(0),
+                          "ls_conv":    np.empty(0, dtype="U1"),
+                          "ls_it":      np.empty(0, dtype=int),
+                          "ls_time":    np.empty(0),
+                          "zoom_used":  np.empty(0, dtype="U1"),
+                          "zoom_conv":  np.empty(0, dtype="U1"),
+                          "zoom_it":    np.empty(0, dtype=int)} 
+        self.__hist_i = 0
 
         self.__old_phi0 = None
-        self.__s = []
-        self.__y = []
-
-
-    def backpropagation(self, model, weights, X, Y):
+        self.__S = None
+        self.__Y = None
+        self.__rho = None
+        self.__gamma = 1.0
+        self.__q_buf = None
+        self.__r_buf = None
+        self.__a = None
+        self.__g_old = None
+        self.__w0 = None
+        self.__norm2 = None
+        self.__fused_scale_add = None
+        self.__pair_dots = None
+        self.__two_loop = None
+        self.__two_loop_m = None
+        self.__dot = np.dot
+        self.__G = None
+        self.__reg2 = None
+        self.__newton_cg = False
+        self.__k = 0
+        self.__w_flat = None
+        self.__g_flat = None
+        self.__g_layers = None
+
+    def optimize(self, model, epochs, X_train, Y_train, validation_data = None, batch_size = None, es = None, verbose = 0):
+        """Allocates the curvature pairs storage and starts the optimization.
+        See isanet.optimizer.Optimizer.optimize for the parameters.
+
+        The 'm' most recent pairs (s, y) are kept in two ring buffers of
+        shape (m, n_vars): the k-th pair is stored in the row k % m, so
+        adding a pair never moves the others.
+
+        The weights of the model are moved in a flat vector and 'model.weights' 
+        is replaced by a list of views into it, in the same way the gradient 
+        of each layer is computed into a view of a flat gradient vector. So the 
+        weights and the gradient are never copied to or from their vector form.
+        """
+        self.n_vars = model.n_vars
+        # the kernels (and Numba) are imported only when an LBFGS optimization starts
+        from isanet.optimizer import _lbfgs_numba as kernels
+        self.__norm2 = kernels.norm2
+        self.__fused_scale_add = kernels.fused_scale_add
+        self.__pair_dots = kernels.pair_dots
+
+        # one history entry for each step (batch) of the remaining epochs
+        n_patterns = X_train.shape[0]
+        n_batches = 1 if batch_size is None else -(-n_patterns // min(batch_size, n_patterns))
+        self.__reserve_history(max(epochs - self.epoch, 0)*n_batches)
+
+        self.__w_flat = make_vector(model.weights).ravel()
+        self.__g_flat = np.empty(self.n_vars)
+        model.weights = restore_w_to_model(model, self.__w_flat)
+        self.__g_layers = restore_w_to_model(model, self.__g_flat)
+        # derivative scale of the L2 term, fixed for the whole optimization
+        self.__reg2 = 2*model.kernel_regularizer[0]
+        self.__S = np.zeros((self.m, self.n_vars), dtype=self.dtype)
+        self.__Y = np.zeros((self.m, self.n_vars), dtype=self.dtype)
+        self.__rho = np.zeros(self.m)
+        self.__gamma = 1.0
+        self.__q_buf = np.empty(self.n_vars, dtype=self.dtype)
+        self.__r_buf = np.empty(self.n_vars, dtype=self.dtype)
+        self.__a = np.empty(self.m)
+        self.__g_old = np.empty(self.n_vars)
+        self.__w0 = np.empty(self.n_vars)
+        # NumPy two-loop: for short vectors np.inner avoids the BLAS call overhead of np.dot
+        self.__dot = np.inner if self.n_vars < 1024 else np.dot
+        # the multi-threaded kernels pay off only when the thread overhead is
+        # small compared to the passes over the vectors
+        parallel = kernels.HAS_NUMBA and self.n_vars > kernels.PARALLEL_MIN_VARS
+        self.__two_loop = None
+        if kernels.HAS_NUMBA:
+            self.__two_loop = kernels.parallel_two_loop() if parallel else kernels.two_loop
+        # for large networks, once 'm' pairs are stored, a kernel unrolled for 
+        # exactly 'm' pairs is used
+        self.__two_loop_m = None
+        if (kernels.HAS_NUMBA and self.m <= kernels.MAX_UNROLLED_M 
+                and self.n_vars >= kernels.UNROLLED_MIN_VARS):
+            self.__two_loop_m = kernels.make_two_loop(self.m, parallel)
+        # without Numba, for larger m, the recursion is done with matrix-vector 
+        # products and the m x m matrix G[i, j] = s_i^T y_j, updated when a pair 
+        # is completed (the compiled two_loop is faster at every size)
+        self.__G = None
+        if not kernels.HAS_NUMBA and self.m > kernels.MAX_UNROLLED_M:
+            self.__G = np.zeros((self.m, self.m))
+        self.__newton_cg = self.n_vars <= self.newton_cg_vars
+        self.__k = 0
+        return super().optimize(model, epochs, X_train, Y_train, validation_data = validation_data, 
+                                batch_size = batch_size, es = es, verbose = verbose)
+
+    def backpropagation(self, model, weights, X, Y, return_output = False):
         """Computes the derivative of 1/n sum_n (y_i -y_i')^2 + lamda*||weights||^2.
 
         Parameters
@@ -133,6 +257,10 @@ class LBFGS(Optimizer):
         Y : array-like of shape (n_samples, n_output)
             The target values.
 
+        return_output : boolean, default=False
+            If True, the output of the network computed in the 
+            Feed-Forward phase is returned too.
+
         Returns
         -------
         list
@@ -142,10 +270,21 @@ class LBFGS(Optimizer):
 
                 E.g. 0 -> first hidden layer, ..., n+1 -> output layer
                 where n is the number of hidden layer in the net.
+
+        array-like of shape (n_samples, n_output)
+            Output of the network for input X, only if 'return_output' is True.
         """
-        g = super().backpropagation(model, weights, X, Y)
-        for i in range(len(g)):
-            g[i]  = (2/X.shape[0])*g[i] + (2*model.kernel_regularizer[0])*weights[i]
+        g, Y_pred = super().backpropagation(model, weights, X, Y, out=self.__g_layers, return_output=True)
+        # g is a list of views into the flat gradient: scale and regularize it in place
+        reg2 = self.__reg2
+        self.__g_flat *= 2/X.shape[0]
+        if weights is model.weights:
+            self.__g_flat += reg2*self.__w_flat
+        else:
+            for g_i, w_i in zip(g, weights):
+                g_i += reg2*w_i
+        if return_output:
+            return g, Y_pred
         return g
 
     def step(self, model, X, Y, verbose):
@@ -172,26 +311,56 @@ class LBFGS(Optimizer):
 
         """
 
-        current_batch_size = X.shape[0]
-
-        w = make_vector(model.weights)
-        g = make_vector(self.backpropagation(model, model.weights, X, Y))
-        norm_g = np.linalg.norm(g)
-        phi0 = metrics.mse_reg(Y, model.predict(X), model, model.weights)
-
-        if ~model.is_fitted and self.epoch == 0:
+        # model.weights and the gradient are views into the flat vectors
+        w = self.__w_flat
+        _, Y_pred = self.backpropagation(model, model.weights, X, Y, return_output=True)
+        g = self.__g_flat
+        norm_g = self.__norm2(g)
+        # reuse the Feed-Forward of the backpropagation instead of model.predict(X)
+        phi0 = metrics.mse_reg(Y, Y_pred, model, model.weights)
+
+        if self.__newton_cg:
+            d = self.__newton_cg_dir(model, X, Y, g)
+        elif self.__k == 0 or self.epoch == 0:
+            # steepest descent for the whole first epoch, the pairs stored 
+            # meanwhile keep rho = 0 until they are completed
             d = - g
         else:
-            self.__y[-1] = g - self.__y[-1]
-            gamma = np.dot(self.__s[-1].T, self.__y[-1])/np.dot(self.__y[-1].T, self.__y[-1])
-            H0 = gamma
-            d = -self.__compute_search_dir(g, H0, self.__s, self.__y)
-            curvature_condition = np.dot(self.__s[-1].T, self.__y[-1])
-            if curvature_condition <= 1e-8:
-                print("curvature condition: {}".format(curvature_condition))
-                raise Exception("Curvature condition is negative")
-
-        phi = phi_function(model, self, w, X, Y, d)
+            # complete the newest pair: y = g_new - g_old
+            last = (self.__k - 1) % self.m
+            np.subtract(g, self.__g_old, out=self.__Y[last])
+            # s^T y, s^T s and y^T y in a single pass over the pair
+            curvature_condition, ss, yy = self.__pair_dots(self.__S[last], self.__Y[last])
+            if self.__S.dtype != np.float64 and curvature_condition < 1e-6*np.sqrt(ss*yy):
+                # weak curvature: stop trusting the low precision pairs
+                self.__promote_to_float64()
+                np.subtract(g, self.__g_old, out=self.__Y[last])
+                curvature_condition, ss, yy = self.__pair_dots(self.__S[last], self.__Y[last])
+            y_last = self.__Y[last]
+            if self.__G is not None:
+                self.__G[last, :] = np.dot(self.__Y, self.__S[last])
+                self.__G[:, last] = np.dot(self.__S, y_last)
+            if curvature_condition <= 0:
+                raise Exception("Curvature condition is negative, curvature condition: {}".format(curvature_condition))
+            if curvature_condition > 1e-8:
+                self.__rho[last] = 1.0/curvature_condition
+                self.__gamma = curvature_condition/yy
+            else:
+                # weak curvature: the pair gets rho = 0, so it does not contribute
+                # to the recursion (no branch in the two loops), and gamma is
+                # kept from the last pair with curvature
+                self.__rho[last] = 0.0
+            # r is a preallocated vector, negated in place
+            d = np.negative(self.__compute_search_dir(g, self.__gamma), out=self.__r_buf)
+
+        # w and g are overwritten by the line search, keep w as the starting 
+        # point of the line search and g for the next y
+        np.copyto(self.__w0, w)
+        if not self.__newton_cg:
+            np.copyto(self.__g_old, g)
+
+        phi = phi_function(model, self, self.__w0.reshape(-1, 1), X, Y, d.reshape(-1, 1),
+                           w_flat = w, g_flat = g)
         ls_verbose = False
         if verbose >=3:
             ls_verbose = True
@@ -200,23 +369,20 @@ class LBFGS(Optimizer):
                                           c1=self.c1, c2=self.c2, verbose = ls_verbose)
 
         self.__old_phi0 = phi0
-        delta = alpha*d
-        w += delta
-        model.weights = restore_w_to_model(model, w)
-
-        # l_w1 = restore_w_to_model(model, w1)
-        # for i in range(0, len(model.weights)):
-        #     regularizer = model.kernel_regularizer[i]*current_batch_size/self.tot_n_patterns
-        #     weights_decay = 2*regularizer*model.weights[i]
-        #     # weights_decay[0,:] = 0 # In ML the bias should not be regularized
-        #     model.weights[i] = l_w1[i] - weights_decay
-        
-        if( len(self.__s) == self.m and len(self.__y) == self.m):
-            self.__s.pop(0)
-            self.__y.pop(0)
-        # w_new - w_old = w_old + alpha*d - w_old = alpha*d = delta
-        self.__s.append(delta) # delta = w_new - w_old
-        self.__y.append(g)
+
+        if self.__newton_cg:
+            # no curvature pairs are used by the Newton-CG direction
+            self.__fused_scale_add(self.__w0, alpha, d, w) # updates model.weights
+        else:
+            # the new pair overwrites the oldest one, y is completed at the next step.
+            # The step is written directly in its slot and added in place to the 
+            # flat weights: the L2 decay is already in g, so no separate decay pass.
+            new = self.__k % self.m
+            s_new = self.__S[new]
+            np.multiply(d, alpha, out=s_new) # s = w_new - w_old = alpha*d
+            np.add(self.__w0, s_new, out=w) # updates model.weights
+            self.__k += 1
+
         if verbose >= 2:
             print("| alpha: {} | ng: {} | ls conv: {}, it: {}, time: {:4.4f} | zoom used: {}, conv: {}, it: {}|".format(
                     alpha, norm_g, ls_log["ls_conv"], ls_log["ls_it"], ls_log["ls_time"],
@@ -225,29 +391,146 @@ class LBFGS(Optimizer):
         return norm_g
 
 
-    def __compute_search_dir(self, g, H0, s, y):
-        q = copy.deepcopy(g)
-        a = []
-        for s_i, y_i in zip(reversed(s), reversed(y)):
-            p = 1/(np.dot(y_i.T, s_i))
-            alpha = p*np.dot(s_i.T,q)
-            a.append(alpha)
-            q -= alpha*y_i
-    
-        r = H0*q
-        for s_i, y_i, a_i in zip(s, y, reversed(a)):
-            p = 1/(np.dot(y_i.T, s_i))
-            b = p*np.dot(y_i.T,r)
-            r += s_i*(a_i -b)
+    def __promote_to_float64(self):
+        self.__S = self.__S.astype(np.float64)
+        self.__Y = self.__Y.astype(np.float64)
+        self.__q_buf = self.__q_buf.astype(np.float64)
+        self.__r_buf = self.__r_buf.astype(np.float64)
+
+    def __hvp(self, model, X, Y, g0, v, out):
+        # finite-difference Hessian-vector product, out = (g(w + eps*v) - g(w))/eps.
+        # w + eps*v is written in the flat weights, then w is restored from w0.
+        w = self.__w_flat
+        eps = np.sqrt(np.finfo(np.float64).eps)*(1 + self.__norm2(self.__w0))/self.__norm2(v)
+        self.__fused_scale_add(self.__w0, eps, v, w)
+        self.backpropagation(model, model.weights, X, Y)
+        np.subtract(self.__g_flat, g0, out=out)
+        out /= eps
+        np.copyto(w, self.__w0)
+        return out
+
+    def __newton_cg_dir(self, model, X, Y, g):
+        # Truncated Newton-CG direction, for major details refer to Wright and 
+        # Nocedal, 'Numerical Optimization', 1999, pp. 140-141 (Algorithm 6.1).
+        norm_g = self.__norm2(g)
+        if norm_g == 0:
+            # stationary point: no direction for the finite differences
+            return -g
+        n = self.n_vars
+        g0 = g.copy()
+        np.copyto(self.__w0, self.__w_flat)
+        z, r, p, Hp = np.zeros(n), g0.copy(), -g0, np.empty(n)
+        eps_tol = min(0.5, np.sqrt(norm_g))*norm_g
+        rr = np.dot(r, r)
+        for j in range(self.cg_maxiter):
+            self.__hvp(model, X, Y, g0, p, Hp)
+            pHp = np.dot(p, Hp)
+            if pHp <= 0:
+                # negative curvature: stop, with the steepest descent at the first iteration
+                if j == 0:
+                    z = -g0
+                break
+            alpha = rr/pHp
+            z += alpha*p
+            r += alpha*Hp
+            rr_new = np.dot(r, r)
+            if np.sqrt(rr_new) < eps_tol:
+                break
+            p *= rr_new/rr
+            p -= r
+            rr = rr_new
+        # the products overwrote the gradient vector
+        np.copyto(g, g0)
+        return z
+
+    def __compute_search_dir(self, g, gamma):
+        count = min(self.__k, self.m)
+        head = (self.__k - count) % self.m
+        if self.__G is not None:
+            return self.__compute_search_dir_gemv(g, gamma, head, count)
+        if self.__two_loop_m is not None and count == self.m:
+            self.__two_loop_m(g, self.__S, self.__Y, self.__rho, head, gamma, self.__r_buf)
+            return self.__r_buf
+        if self.__two_loop is not None:
+            self.__two_loop(g, self.__S, self.__Y, self.__rho, head, count, gamma, self.__r_buf)
+            return self.__r_buf
+        return self.__compute_search_dir_vec(g, gamma, head, count)
+
+    def __compute_search_dir_vec(self, g, gamma, head, count):
+        # NumPy two-loop recursion, every update is done in place in the
+        # preallocated q and r vectors (r is also used as scratch in the 
+        # first loop and q in the second one).
+        S, Y, rho, a, dot = self.__S, self.__Y, self.__rho, self.__a, self.__dot
+        pairs = [(head + j) % self.m for j in range(count)]
+        q, r = self.__q_buf, self.__r_buf
+        np.copyto(q, g)
+        for j in reversed(range(count)):
+            i = pairs[j]
+            a[j] = rho[i]*dot(S[i], q)
+            np.multiply(Y[i], a[j], out=r)
+            np.subtract(q, r, out=q)
+
+        np.multiply(q, gamma, out=r)
+        for j in range(count):
+            i = pairs[j]
+            b = rho[i]*dot(Y[i], r)
+            np.multiply(S[i], a[j] - b, out=q)
+            np.add(r, q, out=r)
+        return r
+
+
+    def __compute_search_dir_gemv(self, g, gamma, head, count):
+        # Two-loop recursion with level-2 BLAS. The dots of both loops depend
+        # on the previous updates, but they can be written as one product with
+        # S (Y) plus a correction using G, e.g. in the first loop 
+        #     s_i^T q = s_i^T g - sum_{j newer than i} a_j s_i^T y_j
+        # so each loop needs two matrix-vector products and O(m^2) work on G.
+        # Rows of empty slots are zero and their coefficients stay zero.
+        S, Y, rho, G = self.__S, self.__Y, self.__rho, self.__G
+        pairs = [(head + j) % self.m for j in range(count)]
+        q, r = self.__q_buf, self.__r_buf
+        np.copyto(q, g)
+
+        sq = np.dot(S, q)
+        a = np.zeros(self.m)
+        for i in reversed(pairs):
+            a[i] = rho[i]*(sq[i] - np.dot(G[i], a))
+        np.dot(a.astype(Y.dtype), Y, out=r)
+        np.subtract(q, r, out=q)             # q = g - Y^T a
+
+        np.multiply(q, gamma, out=r)
+        yr = np.dot(Y, r)
+        c = np.zeros(self.m)                 # c_i = a_i - b_i
+        for i in pairs:
+            c[i] = a[i] - rho[i]*(yr[i] + np.dot(c, G[:, i]))
+        np.dot(c.astype(S.dtype), S, out=q)
+        np.add(r, q, out=r)                  # r = gamma*q + S^T c
         return r
 
+    @property
+    def history(self):
+        return {key: values[:self.__hist_i] for key, values in self.__history.items()}
+
+    def __reserve_history(self, n_steps):
+        # grows the history arrays to hold 'n_steps' more entries
+        size = self.__hist_i + n_steps
+        for key, values in self.__history.items():
+            if values.shape[0] < size:
+                new_values = np.empty(size, dtype=values.dtype)
+                new_values[:self.__hist_i] = values[:self.__hist_i]
+                self.__history[key] = new_values
 
     def __append_history(self, alpha, norm_g, ls_log):
-        self.history["alpha"].append(alpha)
-        self.history["norm_g"].append(norm_g)
-        self.history["ls_conv"].append(ls_log["ls_conv"])
-        self.history["ls_it"].append(ls_log["ls_it"])
-        self.history["ls_time"].append(ls_log["ls_time"])
-        self.history["zoom_used"].append(ls_log["zoom_used"])
-        self.history["zoom_conv"].append(ls_log["zoom_conv"])
-        self.history["zoom_it"].append(ls_log["zoom_it"])
\ No newline at end of file
+        i = self.__hist_i
+        if i == self.__history["alpha"].shape[0]:
+            self.__reserve_history(max(i, 1))
+        h = self.__history
+        h["alpha"][i] = alpha
+        h["norm_g"][i] = norm_g
+        h["ls_conv"][i] = ls_log["ls_conv"]
+        h["ls_it"][i] = ls_log["ls_it"]
+        h["ls_time"][i] = ls_log["ls_time"]
+        h["zoom_used"][i] = ls_log["zoom_used"]
+        h["zoom_conv"][i] = ls_log["zoom_conv"]
+        h["zoom_it"][i] = ls_log["zoom_it"]
+        self.__hist_i += 1
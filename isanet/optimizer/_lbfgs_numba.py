@@ -0,0 +1,305 @@
+""" L-BFGS Numba Kernels.
+This module provides the compiled kernels used by the LBFGS optimizer to
+compute the search direction and to move the weights along it. The curvature 
+pairs are stored row-wise in two ring buffers S and Y of shape (m, n_variables), 
+so that each pair is a contiguous vector and the recursion streams over it 
+once per pair.
+
+The loops over the variables use prange: the two-loop kernels are also 
+available in a multi-threaded version (parallel_two_loop, make_two_loop with 
+parallel=True), worth its thread overhead only for large networks 
+(more than PARALLEL_MIN_VARS variables).
+
+If Numba is not installed the module can still be imported, ``HAS_NUMBA``
+is set to False and the LBFGS optimizer falls back to its NumPy implementation
+(fused_scale_add, pair_dots and norm2 are replaced by equivalent NumPy 
+functions).
+"""
+import math
+import numpy as np
+from functools import lru_cache
+
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
+    prange = range
+
+    def njit(*args, **kwargs):
+        """No-op replacement of numba.njit used when Numba is not available."""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+HAS_NUMBA = numba is not None
+
+# minimum number of variables for which the multi-threaded kernels are used
+PARALLEL_MIN_VARS = 1 << 15
+
+
+@njit(["void(f8[::1], f8[:, ::1], f8[:, ::1], f8[::1], i8, i8, f8, f8[::1])",
+       "void(f8[::1], f4[:, ::1], f4[:, ::1], f8[::1], i8, i8, f8, f4[::1])"],
+      cache=True, fastmath=True)
+def two_loop(g, S, Y, rho, head, count, gamma, out):
+    """Computes r = H*g with the L-BFGS two-loop recursion, where H is the
+    inverse Hessian approximation built from the pairs stored in S and Y
+    and the initial matrix H0 = gamma*I.
+
+    S and Y are used as ring buffers: the 'count' valid pairs are stored,
+    from the oldest to the newest, in the rows head, head+1, ... (mod m).
+    The update of q (r) for a pair and the dot product needed by the next
+    pair are fused, so every pair costs a single pass over its vectors.
+    The pairs and the result can be stored in single precision, the
+    scalar products are always accumulated in double precision.
+
+    Parameters
+    ----------
+    g : array of shape (n_variables,)
+        The gradient.
+
+    S : array of shape (m, n_variables), float64 or float32
+        The steps, s_i = w_{i+1} - w_i.
+
+    Y : array of shape (m, n_variables), same type of S
+        The gradient differences, y_i = g_{i+1} - g_i.
+
+    rho : array of shape (m,)
+        The values 1/(y_i^T s_i) of the stored pairs.
+
+    head : integer
+        Row of the oldest pair.
+
+    count : integer
+        Number of valid pairs.
+
+    gamma : float
+        Scaling factor of the initial matrix H0.
+
+    out : array of shape (n_variables,), same type of S
+        The array where the result is placed.
+    """
+    m = S.shape[0]
+    n = g.shape[0]
+    a = np.empty(count)
+    idx = np.empty(count, np.int64)
+    for i in range(count):
+        idx[i] = (head + i) % m
+
+    if count == 0:
+        for j in prange(n):
+            out[j] = gamma*g[j]
+        return
+
+    # first loop, from the newest to the oldest pair
+    p = idx[count-1]
+    acc = 0.
+    for j in prange(n):
+        out[j] = g[j]
+        acc += S[p, j]*g[j]
+    for i in range(count-1, 0, -1):
+        p = idx[i]
+        pn = idx[i-1]
+        a[i] = rho[p]*acc
+        acc = 0.
+        for j in prange(n):
+            out[j] -= a[i]*Y[p, j]
+            acc += S[pn, j]*out[j]
+    p = idx[0]
+    a[0] = rho[p]*acc
+    acc = 0.
+    for j in prange(n):
+        out[j] = gamma*(out[j] - a[0]*Y[p, j])
+        acc += Y[p, j]*out[j]
+
+    # second loop, from the oldest to the newest pair
+    for i in range(count-1):
+        p = idx[i]
+        pn = idx[i+1]
+        b = rho[p]*acc
+        acc = 0.
+        for j in prange(n):
+            out[j] += (a[i] - b)*S[p, j]
+            acc += Y[pn, j]*out[j]
+    p = idx[count-1]
+    b = rho[p]*acc
+    for j in prange(n):
+        out[j] += (a[count-1] - b)*S[p, j]
+
+
+@lru_cache(maxsize=None)
+def parallel_two_loop():
+    """Returns the multi-threaded version of two_loop (same arguments), 
+    compiled at its first call.
+    """
+    return njit(parallel=True, fastmath=True)(two_loop.py_func)
+
+
+# maximum m for which make_two_loop generates a specialized kernel
+MAX_UNROLLED_M = 8
+
+# minimum number of variables for which the specialized kernels are used: 
+# below it the call overhead and the compilation time are not repaid
+UNROLLED_MIN_VARS = 10000
+
+@lru_cache(maxsize=None)
+def make_two_loop(m, parallel=False):
+    """Generates and compiles a two-loop recursion specialized for exactly 
+    'm' stored pairs, with the loops over the pairs fully unrolled: the 
+    coefficients a_i live in local variables and the rows of the pairs 
+    are computed once from 'head'. The kernel is compiled at its first call.
+
+    The generated function has signature::
+
+            two_loop_m<m>(g, S, Y, rho, head, gamma, out)
+
+    and computes the same result of two_loop(g, S, Y, rho, head, m, gamma, out)
+    (in place in 'out').
+
+    Parameters
+    ----------
+    m : integer
+        Number of pairs, 1 <= m <= MAX_UNROLLED_M.
+
+    parallel : boolean, default=False
+        If True, the loops over the variables are multi-threaded.
+
+    Returns
+    -------
+    callable
+        The compiled kernel.
+    """
+    if not 1 <= m <= MAX_UNROLLED_M:
+        raise ValueError("m must be between 1 and {}, got {}".format(MAX_UNROLLED_M, m))
+    S = ["S{}".format(i) for i in range(m)]
+    Y = ["Y{}".format(i) for i in range(m)]
+    rho = ["rho{}".format(i) for i in range(m)]
+    src = ["def two_loop_m{}(g, S, Y, rho, head, gamma, out):".format(m)]
+    # the pairs from the oldest to the newest
+    for i in range(m):
+        src += ["    p = (head + {}) % {}".format(i, m),
+                "    {} = S[p]".format(S[i]),
+                "    {} = Y[p]".format(Y[i]),
+                "    {} = rho[p]".format(rho[i])]
+    src += ["    n = g.shape[0]",
+            "    acc = 0.",
+            "    for j in prange(n):",
+            "        out[j] = g[j]",
+            "        acc += {}[j]*g[j]".format(S[m-1])]
+    # first loop, from the newest to the oldest pair
+    for i in range(m-1, 0, -1):
+        src += ["    a{} = {}*acc".format(i, rho[i]),
+                "    acc = 0.",
+                "    for j in prange(n):",
+                "        out[j] -= a{}*{}[j]".format(i, Y[i]),
+                "        acc += {}[j]*out[j]".format(S[i-1])]
+    src += ["    a0 = {}*acc".format(rho[0]),
+            "    acc = 0.",
+            "    for j in prange(n):",
+            "        out[j] = gamma*(out[j] - a0*{}[j])".format(Y[0]),
+            "        acc += {}[j]*out[j]".format(Y[0])]
+    # second loop, from the oldest to the newest pair
+    for i in range(m-1):
+        src += ["    b = {}*acc".format(rho[i]),
+                "    acc = 0.",
+                "    for j in prange(n):",
+                "        out[j] += (a{} - b)*{}[j]".format(i, S[i]),
+                "        acc += {}[j]*out[j]".format(Y[i+1])]
+    src += ["    b = {}*acc".format(rho[m-1]),
+            "    for j in prange(n):",
+            "        out[j] += (a{} - b)*{}[j]".format(m-1, S[m-1])]
+    namespace = {"prange": prange}
+    exec("\n".join(src), namespace)
+    return njit(fastmath=True, parallel=parallel)(namespace["two_loop_m{}".format(m)])
+
+
+@njit(["void(f8[::1], f8, f8[::1], f8[::1])",
+       "void(f8[::1], f8, f4[::1], f8[::1])"],
+      cache=True, fastmath=True)
+def fused_scale_add(w0, alpha, d, out):
+    """Computes out = w0 + alpha*d in a single pass, without temporaries.
+
+    Parameters
+    ----------
+    w0 : array of shape (n_variables,)
+        The starting point.
+
+    alpha : float
+        The step size.
+
+    d : array of shape (n_variables,), float64 or float32
+        The direction.
+
+    out : array of shape (n_variables,)
+        The array where the result is placed (e.g. the flat weights of the model).
+    """
+    for i in range(out.shape[0]):
+        out[i] = w0[i] + alpha*d[i]
+
+
+@njit(["UniTuple(f8, 3)(f8[::1], f8[::1])",
+       "UniTuple(f8, 3)(f4[::1], f4[::1])"],
+      cache=True, fastmath=True)
+def pair_dots(s, y):
+    """Computes the scalar products s^T y, s^T s and y^T y of a curvature 
+    pair in a single pass, accumulated in double precision.
+
+    Parameters
+    ----------
+    s : array of shape (n_variables,), float64 or float32
+        The step.
+
+    y : array of shape (n_variables,), same type of s
+        The gradient difference.
+
+    Returns
+    -------
+    tuple of float
+        s^T y, s^T s and y^T y.
+    """
+    sy = 0.
+    ss = 0.
+    yy = 0.
+    for i in range(s.shape[0]):
+        s_i = np.float64(s[i])
+        y_i = np.float64(y[i])
+        sy += s_i*y_i
+        ss += s_i*s_i
+        yy += y_i*y_i
+    return sy, ss, yy
+
+
+@njit("f8(f8[::1])", cache=True, fastmath=True)
+def norm2(x):
+    """Computes the euclidean norm of x in a single pass.
+
+    Parameters
+    ----------
+    x : array of shape (n_variables,)
+
+    Returns
+    -------
+    float
+        The norm of x.
+    """
+    acc = 0.
+    for i in range(x.shape[0]):
+        acc += x[i]*x[i]
+    return math.sqrt(acc)
+
+
+if not HAS_NUMBA:
+    def fused_scale_add(w0, alpha, d, out):
+        """Computes out = w0 + alpha*d (NumPy version)."""
+        np.multiply(d, alpha, out=out)
+        out += w0
+
+    def norm2(x):
+        """Computes the euclidean norm of x (NumPy version)."""
+        return math.sqrt(np.dot(x, x))
+
+    def pair_dots(s, y):
+        """Computes s^T y, s^T s and y^T y in double precision (NumPy version)."""
+        return (np.einsum('i,i->', s, y, dtype=np.float64),
+                np.einsum('i,i->', s, s, dtype=np.float64),
+                np.einsum('i,i->', y, y, dtype=np.float64))
@@ -27,14 +27,31 @@ class phi_function(object):
         The target values.
     
     d : array-like of shape (n_variables, 1)
+
+    w_flat : array of shape (n_variables,), optional
+        Flat vector backing 'model.weights' (each layer is a view into it).
+        When given, each trial point w + a*d is written in place into it 
+        and evaluated on 'model.weights', so the model weights are changed 
+        by the line search and 'w' must not be a view of 'w_flat'.
+
+    g_flat : array of shape (n_variables,), optional
+        Flat vector where the optimizer's backpropagation writes the gradient, 
+        required when 'w_flat' is given.
     """
-    def __init__(self, model, optimizer, w, X, Y, d):
+    def __init__(self, model, optimizer, w, X, Y, d, w_flat = None, g_flat = None):
         self.optimizer = optimizer
         self.model = model
         self.w = w
         self.X = X
         self.Y = Y
         self.d = d
+        self.w_flat = w_flat
+        self.g_flat = g_flat
+        self.scale_add = None
+        if w_flat is not None:
+            # imported here, so that Numba is loaded only by the optimizers using it
+            from isanet.optimizer._lbfgs_numba import fused_scale_add
+            self.scale_add = fused_scale_add
 
     def phi(self, a):
         """Compute the phi value when an alpha 'a' parameter is passed
@@ -44,7 +61,11 @@ class phi_function(object):
         a : scalar
             alpha parameter
         """
-        w_a = restore_w_to_model(self.model, self.w+a*self.d)
+        if self.w_flat is not None:
+            self.scale_add(self.w.ravel(), a, self.d.ravel(), self.w_flat)
+            w_a = self.model.weights
+        else:
+            w_a = restore_w_to_model(self.model, self.w+a*self.d)
         phia = metrics.mse_reg(self.Y, self.optimizer.forward(w_a, self.X), self.model, w_a)
         return phia
         
@@ -59,6 +80,10 @@ class phi_function(object):
         a : scalar
             alpha parameter
         """
+        if self.w_flat is not None:
+            self.scale_add(self.w.ravel(), a, self.d.ravel(), self.w_flat)
+            self.optimizer.backpropagation(self.model, self.model.weights, self.X, self.Y)
+            return np.dot(self.g_flat, self.d.ravel())
         w_a = self.w+a*self.d
         l_w_a = restore_w_to_model(self.model, w_a)
         g_a = make_vector(self.optimizer.backpropagation(self.model, l_w_a, self.X, self.Y))
@@ -310,7 +310,7 @@ class Optimizer(object):
             a = self.model.activations[layer].f(z)
         return a
 
-    def backpropagation(self, model, weights, X, Y):
+    def backpropagation(self, model, weights, X, Y, out = None, return_output = False):
         """Computes the derivative of 1/2 sum_n (y_i -y_i')
 
         Parameters
@@ -328,6 +328,15 @@ class Optimizer(object):
         Y : array-like of shape (n_samples, n_output)
             The target values.
 
+        out : list of arrays, optional
+            Arrays where the gradient of each layer is placed, they must 
+            have the same shape of the weights (e.g. views into a flat 
+            gradient vector). If None, new arrays are allocated.
+
+        return_output : boolean, default=False
+            If True, the output of the network computed in the 
+            Feed-Forward phase is returned too.
+
         Returns
         -------
         list
@@ -337,10 +346,13 @@ class Optimizer(object):
 
                 E.g. 0 -> first hidden layer, ..., n+1 -> output layer
                 where n is the number of hidden layer in the net.
+
+        array-like of shape (n_samples, n_output)
+            Output of the network for input X, only if 'return_output' is True.
         """
         A = [0]*(model.n_layers+1)   # outputs after the activation functions of all layers (input to output)
         Z = [0]*(model.n_layers)     # outputs before the activation functions of all layers (hidden layers to output)
-        g = [0]*model.n_layers       # list of gradient for each layer (hidden to output)
+        g = [None]*model.n_layers if out is None else out  # list of gradient for each layer (hidden to output)
 
         #####################
         # Feed Forward Phase
@@ -360,7 +372,7 @@ class Optimizer(object):
         loss_delta = Y - Y_pred  
         derivates = model.activations[-1].derivative(Y_z_pred)
         d_node_k = -loss_delta*derivates
-        g[model.n_layers-1] = np.dot(A[-2].T, d_node_k)
+        g[model.n_layers-1] = np.dot(A[-2].T, d_node_k, out=g[model.n_layers-1])
 
         ########################
         # Hidden layers H
@@ -370,9 +382,11 @@ class Optimizer(object):
             d = np.dot(d_to_prop, weights[-l+1].T)[:,1:]
             derivates_h = model.activations[-l].derivative(Z[-l])
             d_node_h = d*derivates_h
-            g[model.n_layers-l] = np.dot(A[-l-1].T, d_node_h)
+            g[model.n_layers-l] = np.dot(A[-l-1].T, d_node_h, out=g[model.n_layers-l])
             d_to_prop = d_node_h
         
+        if return_output:
+            return g, Y_pred
         return g 
 
     def step(self, model, X, Y, verbose):